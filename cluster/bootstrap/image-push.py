@@ -5,11 +5,16 @@ to an OCI container registry.
 """
 
 from argparse import ArgumentParser
-from datetime import UTC, datetime
-from hashlib import sha256
-from json import dumps
-from typing import Dict
-from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import file_digest, sha256
+from io import SEEK_END, BytesIO
+from sys import stdin, stdout
+from time import gmtime, strftime, time_ns
+from typing import BinaryIO, Dict, Optional
+from urllib.parse import urlencode
+
+from orjson import dumps, loads
+from requests import Session
 
 from dev.lib.util import console, requestOrDie
 
@@ -19,19 +24,66 @@ def main(
     domain: str,
     server: str,
     version: str,
-    component: bytes,
-    metadata: bytes,
+    component: str,
+    metadata: str,
+):
+    # Send every request through one session to reuse keep-alive connections.
+    push(registry, domain, server, version, component, metadata, Session())
+
+
+def serve(registry: str):
+    """
+    Push an image for each line of standard input,
+    until standard input is closed.
+
+    Each line is a JSON object with the keys
+    `domain`, `server`, `version`, `component`, and `metadata`
+    (same as the corresponding command-line arguments).
+    For each line, write a line of JSON to standard output:
+    `null` on success, or else a string error message.
+    This lets a long-lived caller (e.g. a test harness) push many images
+    without paying for a new process and session each time.
+    """
+    session = Session()
+    for line in stdin:
+        try:
+            push(registry, session=session, **loads(line))
+        except Exception as error:
+            response = dumps(str(error))
+        else:
+            response = dumps(None)
+        stdout.buffer.write(response + b'\n')
+        stdout.buffer.flush()
+
+
+def push(
+    registry: str,
+    domain: str,
+    server: str,
+    version: str,
+    component: str,
+    metadata: str,
+    session: Session,
 ):
-    # Push the component and metadata blobs.
-    componentDigest = pushBlob(registry, domain, server, component)
-    metadataDigest = pushBlob(registry, domain, server, metadata)
+    """Push a single image through the given session. See `main`."""
+    # Push the component and metadata blobs concurrently, streaming them from disk.
+    # The image config depends on both digests, so wait for both uploads to finish.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        componentPush = executor.submit(
+            pushFile, registry, domain, server, component, session
+        )
+        metadataPush = executor.submit(
+            pushFile, registry, domain, server, metadata, session
+        )
+        componentDigest, componentSize = componentPush.result()
+        metadataDigest, metadataSize = metadataPush.result()
 
     # Create and push the image config blob,
     # adhering as closely to the Wasm OCI artifact spec as we can.
     # https://tag-runtime.cncf.io/wgs/wasm/deliverables/wasm-oci-artifact/#configmediatype-applicationvndwasmconfigv0json
     # https://specs.opencontainers.org/image-spec/config/#properties
     imageConfig = {
-        'created': datetime.now(UTC).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+        'created': timestamp(),
         'architecture': 'wasm',
         # This setting for `os` indicates non-compliance with the Wasm OCI spec,
         # because the Protobuf-encoded metadata layer is obviously not a Wasm component.
@@ -43,7 +95,9 @@ def main(
         'component': {},
     }
     imageConfig = serializeJson(imageConfig)
-    imageConfigDigest = pushBlob(registry, domain, server, imageConfig)
+    imageConfigDigest, imageConfigSize = pushBlob(
+        registry, domain, server, BytesIO(imageConfig), session
+    )
 
     # Build the manifest.
     # https://tag-runtime.cncf.io/wgs/wasm/deliverables/wasm-oci-artifact/#manifest-format
@@ -54,18 +108,18 @@ def main(
         # https://specs.opencontainers.org/image-spec/descriptor/
         'config': {
             'mediaType': 'application/vnd.wasm.config.v0+json',
-            'size': len(imageConfig),
+            'size': imageConfigSize,
             'digest': imageConfigDigest,
         },
         'layers': [
             {
                 'mediaType': 'application/wasm',
-                'size': len(component),
+                'size': componentSize,
                 'digest': componentDigest,
             },
             {
                 'mediaType': 'application/protobuf',
-                'size': len(metadata),
+                'size': metadataSize,
                 'digest': metadataDigest,
             },
         ],
@@ -79,6 +133,7 @@ def main(
         tagUrl,
         headers={'Content-Type': 'application/vnd.oci.image.manifest.v1+json'},
         data=serializeJson(manifest),
+        session=session,
     )
 
     console.print(
@@ -86,18 +141,28 @@ def main(
     )
 
 
-def pushBlob(registry: str, domain: str, server: str, content: bytes) -> str:
+def pushBlob(
+    registry: str,
+    domain: str,
+    server: str,
+    content: BinaryIO,
+    session: Optional[Session] = None,
+) -> tuple[str, int]:
     """
-    Push a blob to an OCI registry and return its digest.
+    Push a blob to an OCI registry and return its digest and size.
+
+    The content is streamed twice, once to compute the digest and again to upload it,
+    so the blob never has to be held in memory all at once.
 
     Args:
         registry: Registry URL (e.g. 'http://localhost:5000').
         domain: Domain ID (e.g. '1234567890abcdef1234567890abcdef').
         server: Server ID (e.g. 'some-server').
-        content: Binary content of the blob to push.
+        content: Seekable binary stream of the blob to push, positioned at the start.
+        session: Optional session through which to send requests.
 
     Returns:
-        The digest of the pushed blob (e.g. 'sha256:...').
+        The digest of the pushed blob (e.g. 'sha256:...') and its size in bytes.
     """
     # https://specs.opencontainers.org/distribution-spec/#pushing-blobs
     postUrl = f'{registry}/v2/{domain}/{server}/blobs/uploads/'
@@ -108,6 +173,7 @@ def pushBlob(registry: str, domain: str, server: str, content: bytes) -> str:
         'POST',
         postUrl,
         allow_redirects=True,
+        session=session,
     ).headers.get('Location')
     if not putLocation:
         raise RuntimeError(f"Response missing 'Location' header for '{postUrl}'")
@@ -117,39 +183,54 @@ def pushBlob(registry: str, domain: str, server: str, content: bytes) -> str:
     if putLocation.startswith('/'):
         putLocation = f'{registry}{putLocation}'
 
-    digest = f'sha256:{sha256(content).hexdigest()}'
-
-    # Add the digest as a query parameter.
-    putUrlParsed = urlparse(putLocation)
-    putQueryParsed = parse_qsl(putUrlParsed.query, keep_blank_values=True)
-    putQueryParsed.append(('digest', digest))
-    putUrl = urlunparse(
-        (
-            putUrlParsed.scheme,
-            putUrlParsed.netloc,
-            putUrlParsed.path,
-            putUrlParsed.params,
-            urlencode(putQueryParsed),
-            putUrlParsed.fragment,
-        )
-    )
+    # `file_digest` hashes the stream in C, without buffering it all in memory.
+    digest = f'sha256:{file_digest(content, sha256).hexdigest()}'
+    # Seek to the end to measure the size, then rewind for the upload.
+    size = content.seek(0, SEEK_END)
+    content.seek(0)
+
+    # Add the digest as a query parameter,
+    # appending it to any query the location already carries.
+    separator = '&' if '?' in putLocation else '?'
+    putUrl = f'{putLocation}{separator}{urlencode({"digest": digest})}'
 
     requestOrDie(
         'PUT',
         putUrl,
         headers={
             'Content-Type': 'application/octet-stream',
-            'Content-Length': str(len(content)),
+            'Content-Length': str(size),
         },
         data=content,
+        session=session,
     )
 
-    return digest
+    return (digest, size)
+
+
+def pushFile(
+    registry: str,
+    domain: str,
+    server: str,
+    path: str,
+    session: Optional[Session] = None,
+) -> tuple[str, int]:
+    """Push the contents of a file as a blob. See `pushBlob`."""
+    with open(path, 'rb') as file:
+        return pushBlob(registry, domain, server, file, session)
+
+
+def timestamp() -> str:
+    """Return the current UTC time as an RFC 3339 string with microsecond precision."""
+    seconds, nanoseconds = divmod(time_ns(), 1_000_000_000)
+    dateTime = strftime('%Y-%m-%dT%H:%M:%S', gmtime(seconds))
+    return f'{dateTime}.{nanoseconds // 1000:06d}Z'
 
 
 def serializeJson(json: Dict[str, any]) -> bytes:
     """Helper method to serialize a JSON object as compact, binary data."""
-    return dumps(json, separators=(',', ':')).encode()
+    # `orjson` emits compact UTF-8 bytes directly; no separators or encoding step needed.
+    return dumps(json)
 
 
 if __name__ == '__main__':
@@ -162,46 +243,51 @@ if __name__ == '__main__':
     )
     parser.add_argument(
         '--domain',
-        required=True,
         metavar='ID',
         help="Domain ID (e.g. '1234567890abcdef1234567890abcdef')",
     )
     parser.add_argument(
         '--server',
-        required=True,
         metavar='ID',
         help="Server ID (e.g. 'some-server')",
     )
     parser.add_argument(
         '--version',
-        required=True,
         metavar='STRING',
         help="Version string (e.g. '1.2.3-release')",
     )
     parser.add_argument(
         '--component',
-        required=True,
         metavar='PATH',
         help='Path to compiled Wasm component module',
     )
     parser.add_argument(
         '--metadata',
-        required=True,
         metavar='PATH',
         help='Path to serialized container metadata',
     )
+    parser.add_argument(
+        '--stdin',
+        action='store_true',
+        help='Read images to push from standard input, one JSON object per line',
+    )
     args = parser.parse_args()
 
-    with open(args.component, 'rb') as componentFile:
-        component = componentFile.read()
-    with open(args.metadata, 'rb') as metadataFile:
-        metadata = metadataFile.read()
-
-    main(
-        registry=args.registry,
-        domain=args.domain,
-        server=args.server,
-        version=args.version,
-        component=component,
-        metadata=metadata,
-    )
+    if args.stdin:
+        serve(args.registry)
+    else:
+        missing = [
+            f'--{name}'
+            for name in ('domain', 'server', 'version', 'component', 'metadata')
+            if getattr(args, name) is None
+        ]
+        if missing:
+            parser.error(f'required unless --stdin: {", ".join(missing)}')
+        main(
+            registry=args.registry,
+            domain=args.domain,
+            server=args.server,
+            version=args.version,
+            component=args.component,
+            metadata=args.metadata,
+        )
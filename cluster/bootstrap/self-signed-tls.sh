@@ -1,3 +1,4 @@
+#!/usr/bin/env bash
 tls_generate="$1"
 openssl="$2"
 root_key="$3"
@@ -7,27 +8,61 @@ shift 5
 
 "$tls_generate" --ca --key="$root_key" --cert="$root_cert" --openssl="$openssl"
 
-key="$(mktemp)"
-cert="$(mktemp)"
+# Keep every key pair in a single scratch directory, named by position.
+scratch="$(mktemp -d)"
+declare -A generated
+domains=()
+# Key generation is CPU-bound, so run at most one job per processor.
+max_jobs="$(nproc)"
+running=0
+status=0
 for domain in "$@"
 do
+  # Duplicate domains would map to the same secret name.
+  # Generate each certificate only once.
+  [[ -n "${generated[$domain]}" ]] && continue
+  generated[$domain]=1
+
+  # Once the pool is full, wait for any job to finish before starting another.
+  # Stop starting new jobs as soon as one fails.
+  if (( running >= max_jobs ))
+  then
+    wait -n || status=$?
+    running=$(( running - 1 ))
+  fi
+  (( status != 0 )) && break
+
+  # Each certificate is signed independently by the root CA,
+  # so generate them in parallel.
+  i="${#domains[@]}"
   "$tls_generate" "$domain" \
     --root-key="$root_key" --root-cert="$root_cert" \
-    --key="$key" --cert="$cert" \
-    --openssl="$openssl"
-  cat >> "$resources" <<EOF
-{
-  "kind": "Secret",
-  "apiVersion": "v1",
-  "metadata": {
-    "name": "c-$(echo -n "$domain" | sha224sum | head -c 56)"
-  },
-  "type": "kubernetes.io/tls",
-  "data": {
-    "tls.crt": "$(< "$cert" base64 -w 0)",
-    "tls.key": "$(< "$key" base64 -w 0)"
-  }
-}
-EOF
+    --key="$scratch/$i.key" --cert="$scratch/$i.cert" \
+    --openssl="$openssl" &
+  running=$(( running + 1 ))
+  domains+=("$domain")
 done
-rm "$key" "$cert"
+
+# Wait for every remaining job, even after a failure,
+# so nothing is still writing into the scratch directory when it's removed.
+while (( running > 0 ))
+do
+  wait -n || status=$?
+  running=$(( running - 1 ))
+done
+if (( status != 0 ))
+then
+  rm -r "$scratch"
+  exit "$status"
+fi
+
+# Open the resources file once for the whole loop rather than once per domain.
+for i in "${!domains[@]}"
+do
+  # Emit each secret as a single line of compact JSON (newline-delimited).
+  printf '{"kind":"Secret","apiVersion":"v1","metadata":{"name":"c-%s"},"type":"kubernetes.io/tls","data":{"tls.crt":"%s","tls.key":"%s"}}\n' \
+    "$(echo -n "${domains[$i]}" | sha224sum | head -c 56)" \
+    "$(< "$scratch/$i.cert" base64 -w 0)" \
+    "$(< "$scratch/$i.key" base64 -w 0)"
+done > "$resources"
+rm -r "$scratch"
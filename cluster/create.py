@@ -1,20 +1,23 @@
 """Create a new Vimana cluster."""
 
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import ExitStack
 from datetime import datetime, timedelta
+from http import HTTPStatus
 from os import getenv
 from os.path import join as joinPath
+from tempfile import TemporaryDirectory
 from typing import Dict
 
-from google.cloud.compute_v1 import ImagesClient
-from kubernetes.client import CoreV1Api
+from google.cloud.compute_v1 import ImageFamilyViewsClient
+from kubernetes.client import ApiException, CoreV1Api
 from kubernetes.config import load_kube_config
-from rich.prompt import Confirm
+from kubernetes.utils import FailToCreateError, create_from_yaml
 from urllib3.exceptions import MaxRetryError
 
 from cluster.profiles.load import load as loadProfile
-from dev.lib.util import console, runWithStderr, step, waitFor
+from dev.lib.util import confirm, console, runWithStderr, step, waitFor
 
 # Paths to tool binaries.
 # `RUNFILES_DIR` is set when invoked via `bazel build`.
@@ -23,19 +26,19 @@ RUNFILES_DIR = getenv('RUNFILES_DIR', '..')
 KOPS_PATH = joinPath(RUNFILES_DIR, 'rules_k8s+', 'kops.exe')
 HELM_PATH = joinPath(RUNFILES_DIR, 'rules_k8s+', 'helm.exe')
 
-# Path to the executable to deploy the Vimana operator in a cluster.
-OPERATOR_DEPLOY_PATH = joinPath('operator', 'deploy')
+# Path to the K8s resources that deploy the Vimana operator in a cluster.
+OPERATOR_RESOURCES_PATH = joinPath('operator', 'deploy.yaml')
 
 
-def main(name: str):
+def main(name: str, yes: bool):
     profile = loadProfile(name)
 
     # TODO: Also support other cloud platforms.
     if 'gcp' in profile:
-        gcp(name, profile)
+        gcp(name, profile, yes)
 
 
-def gcp(name: str, profile: Dict[str, object]):
+def gcp(name: str, profile: Dict[str, object], yes: bool):
     profileGcp = profile['gcp']
     project = profileGcp['project']
     imageProject = profileGcp['image-project']
@@ -53,19 +56,31 @@ def gcp(name: str, profile: Dict[str, object]):
     with step(
         f'Looking up latest image from [bold]{imageProject}/{imageFamily}[/bold]'
     ):
-        images = ImagesClient()
-        image = images.get_from_family(project=imageProject, family=imageFamily)
+        # The image family view resolves the latest image
+        # that has been rolled out to the cluster's zone.
+        imageFamilyViews = ImageFamilyViewsClient()
+        image = imageFamilyViews.get(
+            project=imageProject, zone=profile['zone'], family=imageFamily
+        ).image
         imageName = f'{imageProject}/{image.name}'
-        imageCreationTime = datetime.fromisoformat(image.creation_timestamp)
+        # The RFC 3339 timestamp is only displayed, so there's no need to parse it.
+        imageCreationTime = image.creation_timestamp
 
     console.print(
         f'Using image [bold]{imageName}[/bold] created at [bold]{imageCreationTime}[/bold]',
     )
 
-    create(name, profile, '--cloud=gce', f'--project={project}', f'--image={imageName}')
+    create(
+        name,
+        profile,
+        yes,
+        '--cloud=gce',
+        f'--project={project}',
+        f'--image={imageName}',
+    )
 
 
-def create(name: str, profile: Dict[str, object], *args):
+def create(name: str, profile: Dict[str, object], yes: bool, *args):
     start = datetime.now()
 
     with ExitStack() as exitStack:
@@ -73,7 +88,7 @@ def create(name: str, profile: Dict[str, object], *args):
         # between starting to create it and successfully finishing.
         @exitStack.callback
         def cleanup():
-            if Confirm.ask('Clean up partially-initialized cluster?'):
+            if confirm('Clean up partially-initialized cluster?', yes):
                 with step(
                     f'Deleting cluster [bold]{name}[/bold] using [bold]kops[/bold]'
                 ):
@@ -86,63 +101,86 @@ def create(name: str, profile: Dict[str, object], *args):
                         '--yes',
                     )
 
-        with step(f'Provisioning cluster [bold]{name}[/bold] using [bold]kops[/bold]'):
-            runWithStderr(
-                KOPS_PATH,
-                'create',
-                'cluster',
-                name,
-                *args,
-                f'--state={profile["state-store"]}',
-                f'--zones={profile["zone"]}',
-                '--control-plane-count=1',
-                f'--control-plane-size={profile["machine-type"]}',
-                '--node-count=1',
-                f'--node-size={profile["machine-type"]}',
-                '--networking=kube-router',
-                '--kubernetes-feature-gates=+RuntimeClassInImageCriApi',
-                '--set=spec.containerd.skipInstall=true',
-                '--set=spec.containerd.address=/run/vimana/vimanad.sock',
-                # '--topology=private',
-                # '--bastion',
-                '--yes',
-            )
-
-        load_kube_config()
-        coreApi = CoreV1Api()
-
-        def controlPlaneReady():
-            try:
-                coreApi.get_api_resources()
-                return True
-            except MaxRetryError:
-                return False
-
-        waitFor(
-            controlPlaneReady,
-            'the control plane to become ready',
-            timeout=timedelta(seconds=300),
-            interval=timedelta(seconds=10),
-            minimum=timedelta(seconds=60),
-        )
-
-        with step('Installing Envoy Gateway using [bold]helm[/bold]'):
-            runWithStderr(
+        with (
+            TemporaryDirectory() as chartDirectory,
+            ThreadPoolExecutor(max_workers=1) as executor,
+        ):
+            # Pull the Envoy Gateway chart while kops provisions the cluster,
+            # so it's already on disk by the time the cluster is ready to install it.
+            chartPull = executor.submit(
+                runWithStderr,
                 HELM_PATH,
-                'install',
-                'envoy-gateway',
+                'pull',
                 'oci://docker.io/envoyproxy/gateway-helm',
                 '--version=v1.4.2',
-                '--namespace=envoy-gateway-system',
-                '--create-namespace',
-                # Use gateway namespace mode
-                # to create load balancer services in the same namespace as the Gateway resource.
-                # https://gateway.envoyproxy.io/docs/tasks/operations/gateway-namespace-mode/
-                '--set=config.envoyGateway.provider.kubernetes.deploy.type=GatewayNamespace',
+                '--untar',
+                f'--untardir={chartDirectory}',
             )
 
-        with step('Installing the Vimana operator'):
-            runWithStderr(OPERATOR_DEPLOY_PATH)
+            with step(
+                f'Provisioning cluster [bold]{name}[/bold] using [bold]kops[/bold]'
+            ):
+                runWithStderr(
+                    KOPS_PATH,
+                    'create',
+                    'cluster',
+                    name,
+                    *args,
+                    f'--state={profile["state-store"]}',
+                    f'--zones={profile["zone"]}',
+                    '--control-plane-count=1',
+                    f'--control-plane-size={profile["machine-type"]}',
+                    '--node-count=1',
+                    f'--node-size={profile["machine-type"]}',
+                    '--networking=kube-router',
+                    '--kubernetes-feature-gates=+RuntimeClassInImageCriApi',
+                    '--set=spec.containerd.skipInstall=true',
+                    '--set=spec.containerd.address=/run/vimana/vimanad.sock',
+                    # '--topology=private',
+                    # '--bastion',
+                    '--yes',
+                )
+
+            load_kube_config()
+            coreApi = CoreV1Api()
+
+            def controlPlaneReady():
+                try:
+                    coreApi.get_api_resources()
+                    return True
+                # Without an up-front minimum wait, probes can start while the API server
+                # is still coming up behind its load balancer and returning errors.
+                except (ApiException, MaxRetryError):
+                    return False
+
+            waitFor(
+                controlPlaneReady,
+                'the control plane to become ready',
+                timeout=timedelta(seconds=300),
+                interval=timedelta(seconds=10),
+            )
+
+            with step(
+                'Installing Envoy Gateway using [bold]helm[/bold] and the Vimana operator'
+            ):
+                chartPull.result()
+                runWithStderr(
+                    HELM_PATH,
+                    'install',
+                    'envoy-gateway',
+                    joinPath(chartDirectory, 'gateway-helm'),
+                    '--namespace=envoy-gateway-system',
+                    '--create-namespace',
+                    # Use gateway namespace mode
+                    # to create load balancer services in the same namespace as the Gateway resource.
+                    # https://gateway.envoyproxy.io/docs/tasks/operations/gateway-namespace-mode/
+                    '--set=config.envoyGateway.provider.kubernetes.deploy.type=GatewayNamespace',
+                )
+                # The operator watches Gateway and EnvoyProxy resources,
+                # whose CRDs are installed by the Envoy Gateway chart,
+                # so only deploy it once helm is done.
+                # Reuse the API client's connection rather than shelling out to kubectl.
+                deployOperator(coreApi)
 
         # Cluster creation succeeded. No cleanup necessary.
         exitStack.pop_all()
@@ -153,12 +191,32 @@ def create(name: str, profile: Dict[str, object], *args):
         )
 
 
+def deployOperator(coreApi: CoreV1Api):
+    """Create the Vimana operator's resources, if they don't already exist."""
+    try:
+        create_from_yaml(coreApi.api_client, OPERATOR_RESOURCES_PATH)
+    except FailToCreateError as error:
+        # Objects left behind by an earlier, partially-failed run already exist.
+        # Like `kubectl apply`, treat that as success (but don't update them).
+        # Every other object in the file has still been created by this point.
+        if any(
+            exception.status != HTTPStatus.CONFLICT
+            for exception in error.api_exceptions
+        ):
+            raise
+
+
 if __name__ == '__main__':
     parser = ArgumentParser(description=__doc__)
     parser.add_argument(
         'profile',
         help="Name of the profile defined in 'profiles.yaml'",
     )
+    parser.add_argument(
+        '--yes',
+        action='store_true',
+        help='Answer yes to any confirmation prompt',
+    )
     args = parser.parse_args()
 
-    main(args.profile)
+    main(args.profile, args.yes)
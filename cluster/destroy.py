@@ -5,10 +5,8 @@ from datetime import datetime
 from os import getenv
 from os.path import join as joinPath
 
-from rich.prompt import Confirm
-
 from cluster.profiles.load import load as loadProfile
-from dev.lib.util import console, runWithStderr, step
+from dev.lib.util import confirm, console, runWithStderr, step
 
 # Path to the `kops` binary.
 # `RUNFILES_DIR` is set when invoked via `bazel build`.
@@ -17,10 +15,10 @@ RUNFILES_DIR = getenv('RUNFILES_DIR', '..')
 KOPS_PATH = joinPath(RUNFILES_DIR, 'rules_k8s+', 'kops.exe')
 
 
-def main(name: str):
+def main(name: str, yes: bool):
     profile = loadProfile(name)
 
-    if not Confirm.ask(f'Destroy [bold]{name}[/bold]?'):
+    if not confirm(f'Destroy [bold]{name}[/bold]?', yes):
         exit(1)
 
     start = datetime.now()
@@ -47,6 +45,11 @@ if __name__ == '__main__':
         'profile',
         help="Name of the profile defined in 'profiles.yaml'",
     )
+    parser.add_argument(
+        '--yes',
+        action='store_true',
+        help='Answer yes to any confirmation prompt',
+    )
     args = parser.parse_args()
 
-    main(args.profile)
+    main(args.profile, args.yes)
@@ -1,17 +1,29 @@
 """Create a node image for a Vimana cluster."""
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
+from base64 import urlsafe_b64decode
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import ExitStack
 from datetime import datetime, timedelta
+from io import StringIO
+from json import loads
 from os import getenv
 from os.path import basename
 from os.path import join as joinPath
+from socket import create_connection
 from subprocess import DEVNULL, PIPE, run
 from typing import Any, Optional
 
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.hazmat.primitives.serialization import (
+    Encoding,
+    NoEncryption,
+    PrivateFormat,
+)
 from fabric import Connection
 from google.api_core.extended_operation import ExtendedOperation
 from google.auth import default
+from google.auth.credentials import Credentials
 from google.auth.transport.requests import Request
 from google.cloud.compute_v1 import (
     AccessConfig,
@@ -30,7 +42,7 @@ from google.cloud.compute_v1 import (
 )
 from google.cloud.oslogin_v1 import OsLoginServiceClient
 from google.cloud.oslogin_v1.common import SshPublicKey
-from paramiko import RSAKey
+from paramiko import Ed25519Key, SFTPClient
 from paramiko.ssh_exception import NoValidConnectionsError
 from requests import get
 
@@ -46,14 +58,21 @@ CONTAINERD_CONFIG_PATH = joinPath('cluster', 'node', 'containerd-config.toml')
 OPERATION_TIMEOUT = 300
 # Timeout for any VM instances to become available over SSH, in seconds.
 SSH_TIMEOUT = 60
+# SFTP flow-control window for artifact uploads, in bytes.
+SFTP_WINDOW_SIZE = 1 << 27  # 128 MiB
+# Packages that every node image needs on top of the base image.
+PACKAGES = 'cloud-init containerd'
+# Shell condition that holds if the packages are already installed,
+# e.g. because the base image was built with them.
+PACKAGES_INSTALLED = f'dpkg -s {PACKAGES} >/dev/null 2>&1'
 
 
-def main(gcpProject: Optional[str]):
+def main(gcpProject: Optional[str], gcpBaseImage: str):
     version, clean = imageVersion()
 
     # TODO: Also support other cloud platforms.
     if gcpProject is not None:
-        gcp(version, clean, gcpProject)
+        gcp(version, clean, gcpProject, gcpBaseImage)
 
 
 def imageVersion() -> tuple[str, bool]:
@@ -64,15 +83,32 @@ def imageVersion() -> tuple[str, bool]:
     # If this script is run from an unmodified commit of the repository,
     # it is considered clean.
     repoDirectory = getenv('BUILD_WORKSPACE_DIRECTORY')
+    # A single `git status` reports both the current commit and any local changes.
+    # Untracked files are ignored, as with `git diff-index HEAD`.
     result = run(
-        ['git', '-C', repoDirectory, 'diff-index', '--quiet', 'HEAD'],
-        stdout=DEVNULL,
+        [
+            'git',
+            '-C',
+            repoDirectory,
+            'status',
+            '--porcelain=v2',
+            '--branch',
+            '--untracked-files=no',
+        ],
+        stdout=PIPE,
         stderr=DEVNULL,
+        text=True,
+    )
+    lines = result.stdout.splitlines()
+    commit = next(
+        (line.split()[2] for line in lines if line.startswith('# branch.oid ')), None
     )
-    if result.returncode == 0:
+    clean = all(line.startswith('#') for line in lines)
+    if result.returncode == 0 and clean and commit not in (None, '(initial)'):
         # During clean builds,
         # the version of the image is the short form of the current commit hash.
-        result = runOrDie(['git', '-C', repoDirectory, 'rev-parse', '--short', 'HEAD'])
+        # Let Git pick the length, which grows as needed to stay unambiguous.
+        result = runOrDie(['git', '-C', repoDirectory, 'rev-parse', '--short', commit])
         return (result.stdout.strip(), True)
     else:
         # During dirty builds,
@@ -80,10 +116,13 @@ def imageVersion() -> tuple[str, bool]:
         return (str(int(datetime.now().timestamp())), False)
 
 
-def gcp(version: str, clean: bool, project: str):
-    """Create a node image on, and for, Google Cloud Platform."""
-    stockProject = 'debian-cloud'
-    stockFamily = 'debian-12'
+def gcp(version: str, clean: bool, project: str, baseImage: str):
+    """
+    Create a node image on, and for, Google Cloud Platform.
+
+    The base image is given as `<project>/<family>`.
+    """
+    stockProject, stockFamily = baseImage.split('/')
     instanceName = f'image-dummy-{version}'
     instanceZone = 'us-west1-a'
     instanceType = 'e2-medium'
@@ -94,13 +133,24 @@ def gcp(version: str, clean: bool, project: str):
     console.print(f'Image name: [bold]{name}[/bold]')
     console.print(f'Image family: [bold]{family}[/bold]')
 
+    # Look up the application default credentials once
+    # and set up every client up front, rather than at each step.
+    credentials, _project = default()
+    instances = InstancesClient(credentials=credentials)
+    disks = DisksClient(credentials=credentials)
+    snapshots = SnapshotsClient(credentials=credentials)
+    images = ImagesClient(credentials=credentials)
+    osLogin = OsLoginServiceClient(credentials=credentials)
+
     with ExitStack() as exitStack:
+        # Runs cleanup work that need not block later steps.
+        background = exitStack.enter_context(ThreadPoolExecutor(max_workers=1))
+
         # Create a dummy compute instance to host the node image creation process.
         with step(
             f'Creating instance [bold]{instanceName}[/bold]'
             f' from [bold]{stockProject}/{stockFamily}[/bold]'
         ):
-            instances = InstancesClient()
             pollGcpOperation(
                 instances.insert(
                     project=project,
@@ -134,15 +184,24 @@ def gcp(version: str, clean: bool, project: str):
                 ),
             )
 
+        def deleteInstance():
+            pollGcpOperation(
+                instances.delete(
+                    project=project, zone=instanceZone, instance=instanceName
+                )
+            )
+
+        # Set once the instance is being deleted in the background.
+        instanceDeletion: Optional[Future] = None
+
         # From here on, always delete the dummy instance before exiting.
         @exitStack.callback
         def cleanupInstance():
             with step(f'Deleting instance [bold]{instanceName}[/bold]'):
-                pollGcpOperation(
-                    instances.delete(
-                        project=project, zone=instanceZone, instance=instanceName
-                    )
-                )
+                if instanceDeletion is None:
+                    deleteInstance()
+                else:
+                    instanceDeletion.result()
 
         with step('Setting up OS login for SSH access'):
             # Get the public IP address of the newly-created instance.
@@ -152,16 +211,20 @@ def gcp(version: str, clean: bool, project: str):
             instanceIp = instance.network_interfaces[0].access_configs[0].nat_i_p
 
             # Use the email address from the application default credentials for OS login.
-            email = gcpAdcEmail()
+            email = gcpAdcEmail(credentials)
 
-            rsaKey = RSAKey.generate(bits=2048)
+            # The key is ephemeral, so use Ed25519:
+            # generation is native and near-instant, unlike RSA in paramiko.
+            privateKey = Ed25519PrivateKey.generate().private_bytes(
+                Encoding.PEM, PrivateFormat.OpenSSH, NoEncryption()
+            )
+            sshKey = Ed25519Key.from_private_key(StringIO(privateKey.decode()))
             expiry = datetime.now() + timedelta(seconds=SSH_TIMEOUT)
 
-            osLogin = OsLoginServiceClient()
             response = osLogin.import_ssh_public_key(
                 parent=f'users/{email}',
                 ssh_public_key=SshPublicKey(
-                    key=f'ssh-rsa {rsaKey.get_base64()} bootstrap',
+                    key=f'ssh-ed25519 {sshKey.get_base64()} bootstrap',
                     expiration_time_usec=int(expiry.timestamp() * 1_000_000),
                 ),
             )
@@ -169,10 +232,20 @@ def gcp(version: str, clean: bool, project: str):
 
         # Lazy: the connection is not actually opened until `Connection.open`.
         ssh = Connection(
-            host=instanceIp, user=username, connect_kwargs={'pkey': rsaKey}
+            host=instanceIp,
+            user=username,
+            connect_timeout=5,
+            connect_kwargs={'pkey': sshKey},
         )
 
         def sshAvailable():
+            # Probe the port with a bare TCP connection first.
+            # That's much cheaper than a full SSH handshake
+            # while `sshd` is not even listening yet.
+            try:
+                create_connection((instanceIp, 22), timeout=1).close()
+            except OSError:
+                return False
             try:
                 ssh.open()
                 return True
@@ -184,25 +257,46 @@ def gcp(version: str, clean: bool, project: str):
             'SSH to become available',
             timeout=timedelta(seconds=SSH_TIMEOUT),
             interval=timedelta(seconds=1),
-            minimum=timedelta(seconds=5),
         )
 
+        def upload(path: str):
+            # Each upload gets its own SFTP channel, multiplexed over the one SSH connection,
+            # with a large flow-control window so the `vimanad` binary isn't throttled.
+            with SFTPClient.from_transport(
+                ssh.client.get_transport(), window_size=SFTP_WINDOW_SIZE
+            ) as sftp:
+                sftp.put(path, basename(path))
+
         with step(f'Uploading artifacts to [bold]{instanceName}[/bold]'):
             # These are all uploaded in the user's home directory by default.
             # We lack the root filesystem privileges necessary
             # to upload them directly to their proper destinations.
             # Follow up with `sudo mv` commands over SSH.
-            ssh.put(VIMANAD_PATH)
-            ssh.put(VIMANAD_SERVICE_PATH)
-            ssh.put(CONTAINERD_CONFIG_PATH)
+            with ThreadPoolExecutor() as executor:
+                # Fetching packages is the slowest part of configuration.
+                # Download them on a separate channel while the artifacts upload
+                # so the install step only has to unpack from the local cache.
+                packageDownload = executor.submit(
+                    ssh.run,
+                    f'{PACKAGES_INSTALLED} || (sudo apt-get update'
+                    f' && sudo apt-get install -y --download-only {PACKAGES})',
+                    hide=True,
+                )
+                # Consume the results to propagate any exceptions.
+                list(
+                    executor.map(
+                        upload,
+                        [VIMANAD_PATH, VIMANAD_SERVICE_PATH, CONTAINERD_CONFIG_PATH],
+                    )
+                )
+                packageDownload.result()
 
         with step(f'Configuring [bold]{instanceName}[/bold]'):
             ssh.run(
                 '\n'.join(
                     [
                         'set -e',
-                        'sudo apt-get update',
-                        'sudo apt-get install -y cloud-init containerd',
+                        f'{PACKAGES_INSTALLED} || sudo apt-get install -y {PACKAGES}',
                         f"sudo mv ~/'{basename(VIMANAD_PATH)}' /usr/bin/vimanad",
                         f"sudo mv ~/'{basename(VIMANAD_SERVICE_PATH)}' /etc/systemd/system/vimanad.service",
                         f"sudo mv ~/'{basename(CONTAINERD_CONFIG_PATH)}' /etc/containerd/config.toml",
@@ -225,7 +319,6 @@ def gcp(version: str, clean: bool, project: str):
             )
 
         with step(f'Creating snapshot [bold]{snapshotName}[/bold]'):
-            disks = DisksClient()
             pollGcpOperation(
                 disks.create_snapshot(
                     project=project,
@@ -237,17 +330,19 @@ def gcp(version: str, clean: bool, project: str):
                 ),
             )
 
+        # The snapshot holds everything needed from the instance,
+        # so delete the instance while the image is being created.
+        instanceDeletion = background.submit(deleteInstance)
+
         # From here on, always delete the snapshot before exiting.
         @exitStack.callback
         def cleanupSnapshot():
             with step(f'Deleting snapshot [bold]{snapshotName}[/bold]'):
-                snapshots = SnapshotsClient()
                 pollGcpOperation(
                     snapshots.delete(project=project, snapshot=snapshotName)
                 )
 
         with step(f'Creating image [bold]{name}[/bold] from the snapshot'):
-            images = ImagesClient()
             pollGcpOperation(
                 images.insert(
                     project=project,
@@ -264,15 +359,30 @@ def gcp(version: str, clean: bool, project: str):
         )
 
 
-def gcpAdcEmail():
+def gcpAdcEmail(credentials: Credentials):
     """
     Return the email address of the currently-signed-in account
     for GCP's application default credentials (ADC).
     """
-    credentials, _project = default()
     if not credentials.valid:
         credentials.refresh(Request())
 
+    # Service account credentials know their own email address.
+    email = getattr(credentials, 'service_account_email', None)
+    if email is not None and email != 'default':
+        return email
+
+    # User credentials carry an ID token once refreshed,
+    # which already contains the email claim.
+    # The token came straight from Google over TLS, so skip verification.
+    idToken = getattr(credentials, 'id_token', None)
+    if idToken is not None:
+        payload = idToken.split('.')[1]
+        claims = loads(urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        if 'email' in claims:
+            return claims['email']
+
+    # Otherwise, fall back to an extra round trip to the userinfo endpoint.
     response = get(
         'https://www.googleapis.com/oauth2/v1/userinfo',
         headers={'Authorization': f'Bearer {credentials.token}'},
@@ -303,11 +413,29 @@ def pollGcpOperation(operation: ExtendedOperation) -> Any:
     return result
 
 
+def imageFamilyArgument(value: str) -> str:
+    """Argument type for image families in the form `<project>/<family>`."""
+    project, slash, family = value.partition('/')
+    if not (project and slash and family) or '/' in family:
+        raise ArgumentTypeError(f"expected '<project>/<family>', got '{value}'")
+    return value
+
+
 if __name__ == '__main__':
     parser = ArgumentParser(description=__doc__)
     parser.add_argument(
         '--gcp-project', help='ID of the GCP project in which to create the node image'
     )
+    parser.add_argument(
+        '--gcp-base-image',
+        default='debian-cloud/debian-12',
+        type=imageFamilyArgument,
+        metavar='PROJECT/FAMILY',
+        help=(
+            "Image family to build from, as '<project>/<family>'."
+            f' Package installation is skipped if it already includes: {PACKAGES}'
+        ),
+    )
     args = parser.parse_args()
 
-    main(args.gcp_project)
+    main(args.gcp_project, args.gcp_base_image)
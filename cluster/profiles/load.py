@@ -1,7 +1,16 @@
+from copy import deepcopy
+from functools import lru_cache
+from os import stat
 from os.path import join as joinPath
 from typing import Dict
 
-from yaml import safe_load as loadYaml
+from yaml import load as loadYaml
+
+try:
+    # Prefer the libyaml-backed loader, which is much faster than pure Python.
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 PROFILES_PATH = joinPath('cluster', 'profiles', 'profiles.yaml')
 
@@ -13,12 +22,31 @@ def load(name: str) -> Dict[str, object]:
     Normalizing involves populating optional fields with default values.
     """
 
-    with open(PROFILES_PATH, 'r') as file:
-        profiles = loadYaml(file)
+    profiles = _loadProfiles(PROFILES_PATH, stat(PROFILES_PATH).st_mtime_ns)
     if name not in profiles:
         raise ValueError(f'Profile {name} not found')
-    profile = profiles[name]
+    # Normalize a copy so the cached profiles stay pristine.
+    profile = deepcopy(profiles[name])
+    _normalize(profile)
+    return profile
+
 
+def loadAll() -> Dict[str, Dict[str, object]]:
+    """
+    Load and normalize every profile, keyed by name.
+
+    Equivalent to calling `load` for each profile name, with a single parse.
+    """
+
+    profiles = _loadProfiles(PROFILES_PATH, stat(PROFILES_PATH).st_mtime_ns)
+    # Normalize a copy so the cached profiles stay pristine.
+    profiles = deepcopy(profiles)
+    for profile in profiles.values():
+        _normalize(profile)
+    return profiles
+
+
+def _normalize(profile: Dict[str, object]):
     if 'gcp' in profile:
         _populateDefaultsGcp(profile['gcp'])
     if 'aws' in profile:
@@ -26,7 +54,13 @@ def load(name: str) -> Dict[str, object]:
     if 'azure' in profile:
         _populateDefaultsAzure(profile['azure'])
 
-    return profile
+
+@lru_cache(maxsize=None)
+def _loadProfiles(path: str, mtime: int) -> Dict[str, Dict[str, object]]:
+    # The modification time is only part of the cache key,
+    # so an edited file is parsed again.
+    with open(path, 'r') as file:
+        return loadYaml(file, Loader=SafeLoader)
 
 
 def _populateDefaultsGcp(gcp: Dict[str, object]):
@@ -1,45 +1,86 @@
 """Validate cluster profiles against a JSON schema."""
 
-from unittest import TestCase, main
+from os import utime
 from os.path import join as joinPath
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main
+from unittest.mock import patch
 
-from jsonschema import validate
+from jsonschema.validators import validator_for
 from yaml import safe_load as loadYaml
 
-from cluster.profiles.load import PROFILES_PATH, load as loadProfile
+from cluster.profiles.load import PROFILES_PATH
+from cluster.profiles.load import load as loadProfile
+from cluster.profiles.load import loadAll as loadProfiles
 
 SCHEMA_PATH = joinPath('cluster', 'profiles', 'schema.yaml')
 
 
 class ProfilesValidationTest(TestCase):
-    def test_raw(self):
-        """Test that the raw `profiles.yaml` file is valid."""
-
+    @classmethod
+    def setUpClass(cls):
+        # Parse both files once for the whole test case.
         with open(SCHEMA_PATH, 'r') as file:
             schema = loadYaml(file)
+        # Check and compile the schema once for all validations.
+        validatorClass = validator_for(schema)
+        validatorClass.check_schema(schema)
+        cls.validator = validatorClass(schema)
         with open(PROFILES_PATH, 'r') as file:
-            profiles = loadYaml(file)
+            cls.rawProfiles = loadYaml(file)
 
-        validate(instance=profiles, schema=schema)
+    def test_raw(self):
+        """Test that the raw `profiles.yaml` file is valid."""
+
+        self.validator.validate(self.rawProfiles)
 
     def test_normalized(self):
         """
         Test all profiles are valid after being loaded and normalized.
 
-        If this test fails but `test_raw` succeeds, that indicates a problem with `loadProfile`.
+        If this test fails but `test_raw` succeeds, that indicates a problem with `loadProfiles`.
         """
 
-        with open(SCHEMA_PATH, 'r') as file:
-            schema = loadYaml(file)
-        with open(PROFILES_PATH, 'r') as file:
-            rawProfiles = loadYaml(file)
+        for name, profile in loadProfiles().items():
+            self.validator.validate({name: profile})
+
+    def test_loadByName(self):
+        """Test that loading a single profile agrees with loading them all."""
+
+        profiles = loadProfiles()
+        self.assertEqual(profiles.keys(), self.rawProfiles.keys())
+        for name, profile in profiles.items():
+            self.assertEqual(loadProfile(name), profile)
+
+    def test_mutationDoesNotLeak(self):
+        """Test that mutating a loaded profile does not affect later loads."""
+
+        for name in self.rawProfiles:
+            profile = loadProfile(name)
+            expected = loadProfile(name)
+            profile.clear()
+            profile['mutated'] = {'nested': True}
+            self.assertEqual(loadProfile(name), expected)
+
+            profiles = loadProfiles()
+            profiles[name]['mutated'] = True
+            self.assertEqual(loadProfiles()[name], expected)
+
+    def test_reloadOnModification(self):
+        """Test that editing the profiles file invalidates the cached parse."""
 
-        for name in rawProfiles.keys():
-            profiles = {name: loadProfile(name)}
-            import sys
+        with TemporaryDirectory() as directory:
+            path = joinPath(directory, 'profiles.yaml')
+            with patch('cluster.profiles.load.PROFILES_PATH', path):
+                with open(path, 'w') as file:
+                    file.write('test: {zone: before}\n')
+                utime(path, ns=(1_000_000_000, 1_000_000_000))
+                self.assertEqual(loadProfile('test'), {'zone': 'before'})
 
-            print(profiles, file=sys.stderr)
-            validate(instance=profiles, schema=schema)
+                with open(path, 'w') as file:
+                    file.write('test: {zone: after}\n')
+                utime(path, ns=(2_000_000_000, 2_000_000_000))
+                self.assertEqual(loadProfile('test'), {'zone': 'after'})
 
 
 if __name__ == '__main__':
@@ -1,6 +1,9 @@
-from os import listdir
-from os.path import exists, splitext
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from os import scandir
 from os.path import join as joinPath
+from os.path import splitext
+from pathlib import Path
 from typing import Callable
 from unittest import TestCase, main
 
@@ -12,32 +15,63 @@ DATA_PATH = joinPath('compiler', 'tests', 'data')
 # The test class is populated dynamically
 # based on the content of the test data directory.
 class ProtocPluginTest(TestCase):
-    pass
+    # Pending `protoc` output for each test data group, keyed by root name.
+    outputs: dict[str, Future]
 
+    @classmethod
+    def setUpClass(cls):
+        # The plugin merges all of its input files into a single `server.wit`,
+        # so each group still needs its own `protoc` invocation,
+        # but the invocations are independent and can all run concurrently.
+        cls.executor = ThreadPoolExecutor()
+        cls.outputs = {
+            rootName: cls.executor.submit(
+                protoc, joinPath(DATA_PATH, f'{rootName}.proto')
+            )
+            for rootName, extensions in dataGroups.items()
+            if '.proto' in extensions
+        }
 
-def generateTestCase(rootName: str) -> Callable[[TestCase], None]:
-    """Generate a test case based on a group of test data files that share a root name."""
+    @classmethod
+    def tearDownClass(cls):
+        cls.executor.shutdown()
+
+
+def generateTestCase(rootName: str, extensions: set[str]) -> Callable[[TestCase], None]:
+    """
+    Generate a test case based on a group of test data files that share a root name.
+
+    The extensions are those of every file in the group.
+    """
 
     def testCase(self):
         witFile = joinPath(DATA_PATH, f'{rootName}.wit')
-        self.assertTrue(exists(witFile), f"File '{witFile}' is missing")
+        self.assertIn('.wit', extensions, f"File '{witFile}' is missing")
         protoFile = joinPath(DATA_PATH, f'{rootName}.proto')
-        self.assertTrue(exists(protoFile), f"File '{protoFile}' is missing")
+        self.assertIn('.proto', extensions, f"File '{protoFile}' is missing")
 
-        result = protoc(protoFile)
+        result = self.outputs[rootName].result()
 
         # Display unmatching outputs in their entirety; not just the lines that differ.
         self.maxDiff = None
-        with open(witFile, 'r') as expectedWit:
-            self.assertEqual(result.wit, expectedWit.read())
+        self.assertEqual(result.wit, Path(witFile).read_text('utf-8'))
 
     return testCase
 
 
 # Each test case is defined by a group of files in the data directory
 # which all share a filename root but differ in their extension.
-for rootName in set(splitext(path)[0] for path in listdir(DATA_PATH)):
-    setattr(ProtocPluginTest, f'test_{rootName}', generateTestCase(rootName))
+# Scan the directory once, grouping extensions by root name,
+# so test cases need not check for the existence of each file again.
+dataGroups = defaultdict(set)
+with scandir(DATA_PATH) as dataEntries:
+    for entry in dataEntries:
+        rootName, extension = splitext(entry.name)
+        dataGroups[rootName].add(extension)
+for rootName, extensions in dataGroups.items():
+    setattr(
+        ProtocPluginTest, f'test_{rootName}', generateTestCase(rootName, extensions)
+    )
 
 
 if __name__ == '__main__':
@@ -1,7 +1,8 @@
 from dataclasses import dataclass
 from os.path import abspath
 from os.path import join as joinPath
-from subprocess import Popen
+from pathlib import Path
+from subprocess import DEVNULL, PIPE, run
 from tempfile import TemporaryDirectory
 
 PROTOC_PATH = joinPath('..', 'protobuf+', 'protoc')
@@ -27,9 +28,12 @@ def protoc(*files, include=None) -> ProtocOutput:
             + [f'--proto_path={path}' for path in (include or [])]
             + list(files)
         )
-        if (status := Popen(args).wait()) != 0:
-            raise RuntimeError(f'Failed executing protoc (status={status})')
+        # Capture stderr rather than writing to the terminal,
+        # since several invocations may run concurrently.
+        result = run(args, stdout=DEVNULL, stderr=PIPE, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(
+                f'Failed executing protoc (status={result.returncode}):\n{result.stderr}'
+            )
 
-        with open(joinPath(output, 'server.wit'), 'r') as witFile:
-            wit = witFile.read()
-        return ProtocOutput(wit=wit)
+        return ProtocOutput(wit=Path(output, 'server.wit').read_text('utf-8'))
@@ -7,15 +7,21 @@ If no particular languages are specified, upgrade dependencies for all languages
 """
 
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from json import loads as loadsJson
-from os import chdir, getenv
+from os import chdir, getenv, replace
 from os.path import join as joinPath
 from os.path import realpath
-from re import compile as compileRegex
-from typing import Dict
+from string import ascii_uppercase
+from typing import Callable, Iterable, List, Optional
 
 from packaging.requirements import Requirement, SpecifierSet
-from tomlkit import dump as dumpToml
+from packaging.utils import InvalidSdistFilename, InvalidWheelFilename
+from packaging.utils import parse_sdist_filename as parseSdistFilename
+from packaging.utils import parse_wheel_filename as parseWheelFilename
+from requests import Session
+from requests.adapters import HTTPAdapter
+from tomlkit import dumps as dumpsToml
 from tomlkit import load as loadToml
 
 from dev.lib.util import console, requestOrDie, runOrDie, step
@@ -31,6 +37,15 @@ GO_PATH = realpath(
     joinPath(RUNFILES_DIR, 'rules_go+', 'go', 'tools', 'go_bin_runner', 'bin', 'go')
 )
 
+# Maximum number of concurrent registry lookups.
+MAX_LOOKUPS = 32
+
+# Translation table to encode module paths for the Go module proxy protocol.
+# Uppercase letters must be replaced with '!' followed by the lowercase equivalent.
+GO_PROXY_ENCODING = str.maketrans(
+    {char: f'!{char.lower()}' for char in ascii_uppercase}
+)
+
 
 def main(bazel: bool = True, rust: bool = True, python: bool = True, go: bool = True):
     # Move to the top level of the Git Repo for this function.
@@ -39,28 +54,46 @@ def main(bazel: bool = True, rust: bool = True, python: bool = True, go: bool =
     # https://bazel.build/docs/user-manual#running-executables
     chdir(getenv('BUILD_WORKSPACE_DIRECTORY'))
 
+    # Share one session across all lookups so connections to each registry are reused.
+    # Size its connection pools to match the number of concurrent lookups;
+    # otherwise, connections beyond the default of 10 per host would be discarded.
+    session = Session()
+    session.mount('https://', HTTPAdapter(pool_maxsize=MAX_LOOKUPS))
+
     if bazel:
         with step('Upgrading Bazel module dependencies'):
-            upgradeBazelModules()
+            upgradeBazelModules(session)
     if rust:
         with step('Upgrading Rust crate dependencies'):
-            upgradeRustCrates()
+            upgradeRustCrates(session)
     if python:
         with step('Upgrading Python package dependencies'):
-            upgradePythonPackages()
+            upgradePythonPackages(session)
     if go:
         with step('Upgrading Go module dependencies'):
-            upgradeGoModules()
+            upgradeGoModules(session)
+
 
+def fetchAll(fetch: Callable[[str], str], names: Iterable[str]) -> List[str]:
+    """
+    Look up the latest version for each name concurrently.
 
-def upgradeBazelModules():
+    Lookups are network-bound, so overlapping them saves a round trip per dependency.
+    Results are returned in the same order as the names.
+    """
+    names = list(names)
+    workers = max(1, min(MAX_LOOKUPS, len(names)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(fetch, names))
+
+
+def upgradeBazelModules(session: Session):
     # Read the name and version of each `bazel_dep` in `MODULE.bazel`.
     result = runOrDie(
         [BUILDOZER_PATH, 'print name version', '//MODULE.bazel:%bazel_dep']
     )
 
-    # Create a list of Buildozer commands to run a batch of updates together.
-    updates = []
+    modules = []
     for line in result.stdout.splitlines():
         name, currentVersion = line.split()
 
@@ -72,12 +105,16 @@ def upgradeBazelModules():
             )
             continue
 
-        # Get the latest version from the registry.
-        latestVersion = requestOrDie(
-            'GET',
-            f'https://raw.githubusercontent.com/bazelbuild/bazel-central-registry/main/modules/{name}/metadata.json',
-        ).json()['versions'][-1]
+        modules.append((name, currentVersion))
+
+    # Get the latest versions from the registry.
+    latestVersions = fetchAll(
+        lambda name: latestBazelModule(name, session), (name for name, _ in modules)
+    )
 
+    # Create a list of Buildozer commands to run a batch of updates together.
+    updates = []
+    for (name, currentVersion), latestVersion in zip(modules, latestVersions):
         if currentVersion != latestVersion:
             updates.append(
                 f'replace version {currentVersion} {latestVersion}|//MODULE.bazel:{name}\n'
@@ -88,26 +125,42 @@ def upgradeBazelModules():
     runOrDie([BUILDOZER_PATH, '-f', '-'], input=''.join(updates))
 
 
-def upgradeRustCrates():
+def latestBazelModule(name: str, session: Session) -> str:
+    return requestOrDie(
+        'GET',
+        f'https://raw.githubusercontent.com/bazelbuild/bazel-central-registry/main/modules/{name}/metadata.json',
+        session=session,
+    ).json()['versions'][-1]
+
+
+def upgradeRustCrates(session: Session):
     with open('Cargo.toml', 'r') as cargoFile:
         cargo = loadToml(cargoFile)
     dependencies = cargo['dependencies']
 
-    for name in dependencies.keys():
-        # Rust dependencies are expressed as either a simple version string,
-        # or a JSON object with the field 'version'.
-        if isinstance(dependencies[name], dict):
-            upgradeRustCrate(name, dependencies[name], 'version')
-        else:
-            upgradeRustCrate(name, dependencies, name)
+    # Rust dependencies are expressed as either a simple version string,
+    # or a JSON object with the field 'version'.
+    crates = [
+        (name, dependencies[name], 'version')
+        if isinstance(dependencies[name], dict)
+        else (name, dependencies, name)
+        for name in dependencies.keys()
+    ]
+
+    latestVersions = fetchAll(
+        lambda name: latestRustCrate(name, session), (name for name, _, _ in crates)
+    )
 
-    with open('Cargo.toml', 'w') as cargoFile:
-        dumpToml(cargo, cargoFile)
+    for (name, versionObject, versionKey), latestVersion in zip(crates, latestVersions):
+        currentVersion = versionObject[versionKey]
+        if currentVersion != latestVersion:
+            versionObject[versionKey] = latestVersion
+            printUpdate(name, currentVersion, latestVersion, 'yellow')
 
+    writeAtomically('Cargo.toml', dumpsToml(cargo))
 
-def upgradeRustCrate(crateName, versionObject: Dict[str, any], versionKey: str):
-    currentVersion = versionObject[versionKey]
 
+def latestRustCrate(crateName: str, session: Session) -> str:
     # Compute the directory for the package's metadata on crates.io.
     # https://doc.rust-lang.org/cargo/reference/registry-index.html#index-files
     indexDirectory = (
@@ -119,20 +172,18 @@ def upgradeRustCrate(crateName, versionObject: Dict[str, any], versionKey: str):
     )
 
     # Get the latest version from crates.io.
-    latestVersion = loadsJson(
+    return loadsJson(
         requestOrDie(
             'GET',
             f'https://index.crates.io/{indexDirectory}/{crateName}',
+            session=session,
         ).content.splitlines()[-1]
     )['vers']
 
-    if currentVersion != latestVersion:
-        versionObject[versionKey] = latestVersion
-        printUpdate(crateName, currentVersion, latestVersion, 'yellow')
 
-
-def upgradePythonPackages():
-    updatedLines = []
+def upgradePythonPackages(session: Session):
+    # Each line paired with the requirement it expresses, if any.
+    lines: List[tuple[str, Optional[Requirement]]] = []
 
     with open('requirements.txt', 'r') as requirementsFile:
         for line in requirementsFile:
@@ -150,86 +201,167 @@ def upgradePythonPackages():
                 assert requirement.url is None, (
                     f"Cannot handle requirement URL '{requirement.url}'"
                 )
+                lines.append((line, requirement))
+            else:
+                lines.append((line, None))
 
-                # Get the latest version from PyPI.
-                latestVersion = requestOrDie(
-                    'GET',
-                    f'https://pypi.org/pypi/{requirement.name}/json',
-                ).json()['info']['version']
-
-                if not requirement.specifier.contains(latestVersion):
-                    oldSpecifier = requirement.specifier
-                    requirement.specifier = SpecifierSet(f'=={latestVersion}')
-                    updatedLines.append(f'{requirement}\n')
-                    printUpdate(
-                        requirement.name,
-                        str(oldSpecifier),
-                        str(requirement.specifier),
-                        'blue',
-                    )
-                    continue
-
-            # If the line did not express a requirement (i.e. it was a blank line or comment),
-            # or if the version specifier already includes the latest version,
-            # copy the line verbatim to the updated file.
-            updatedLines.append(line)
-
-    with open('requirements.txt', 'w') as requirementsFile:
-        for line in updatedLines:
-            requirementsFile.write(line)
-
-
-def upgradeGoModules():
-    goDependencyRegex = compileRegex(r'^\t([^\s]+) ([^\s]+)(| // indirect)\n$')
+    names = [requirement.name for _, requirement in lines if requirement is not None]
+    latestVersions = dict(
+        zip(names, fetchAll(lambda name: latestPythonPackage(name, session), names))
+    )
+
+    updatedLines = []
+    for line, requirement in lines:
+        if requirement is not None:
+            latestVersion = latestVersions[requirement.name]
+            if not requirement.specifier.contains(latestVersion):
+                oldSpecifier = requirement.specifier
+                requirement.specifier = SpecifierSet(f'=={latestVersion}')
+                updatedLines.append(f'{requirement}\n')
+                printUpdate(
+                    requirement.name,
+                    str(oldSpecifier),
+                    str(requirement.specifier),
+                    'blue',
+                )
+                continue
+
+        # If the line did not express a requirement (i.e. it was a blank line or comment),
+        # or if the version specifier already includes the latest version,
+        # copy the line verbatim to the updated file.
+        updatedLines.append(line)
+
+    writeAtomically('requirements.txt', ''.join(updatedLines))
+
+
+def latestPythonPackage(name: str, session: Session) -> str:
+    # Get the latest version from PyPI's simple index (PEP 691),
+    # which only lists files and versions
+    # and is much smaller than the full package metadata from the JSON API.
+    index = requestOrDie(
+        'GET',
+        f'https://pypi.org/simple/{name}/',
+        headers={'Accept': 'application/vnd.pypi.simple.v1+json'},
+        session=session,
+    ).json()
+
+    # Only consider versions with at least one distribution that hasn't been yanked.
+    versions = set()
+    for file in index['files']:
+        if file.get('yanked'):
+            continue
+        try:
+            if file['filename'].endswith('.whl'):
+                versions.add(parseWheelFilename(file['filename'])[1])
+            else:
+                versions.add(parseSdistFilename(file['filename'])[1])
+        except (InvalidSdistFilename, InvalidWheelFilename):
+            # Legacy distribution formats (eggs, installers, etc.).
+            continue
 
+    # Prefer the latest stable version,
+    # but fall back to the latest pre-release if there are no stable versions.
+    latest = max(
+        (version for version in versions if not version.is_prerelease), default=None
+    ) or max(versions, default=None)
+    if latest is None:
+        raise RuntimeError(f"No installable versions of '{name}' found on PyPI")
+    return str(latest)
+
+
+def upgradeGoModules(session: Session):
     # Manually parse the `go.mod` file line by line, building updated contents for it.
     # Perhaps there's a more robust solution using the `go` binary,
     # but using `go list -m` and `go get` was often "too smart"
     # and would run into weird errors.
-    updatedLines = []
+    # Each line is paired with the dependency it declares, if any.
+    lines = []
     with open('go.mod', 'r') as goModFile:
         # Whether we're currently parsing inside a `require ( ... )` block.
         inRequire = False
 
         for line in goModFile:
+            dependency = None
             if line == 'require (\n':
                 assert not inRequire
                 inRequire = True
             elif line == ')\n':
                 assert inRequire
                 inRequire = False
-            elif inRequire and (match := goDependencyRegex.match(line)) is not None:
-                path = match.group(1)
-                currentVersion = match.group(2)
-                indirect = match.group(3)
-
-                # Encode the module path for the Go module proxy protocol.
-                # Uppercase letters must be replaced with '!' followed by the lowercase equivalent.
-                # https://go.dev/ref/mod#goproxy-protocol
-                encodedPath = ''.join(
-                    f'!{char.lower()}' if char.isupper() else char for char in path
-                )
+            elif inRequire:
+                dependency = parseGoDependency(line)
+            lines.append((line, dependency))
 
-                # Get the latest version using the Go module proxy protocol.
-                latestVersion = requestOrDie(
-                    'GET',
-                    f'https://proxy.golang.org/{encodedPath}/@latest',
-                ).json()['Version']
+    paths = [dependency[0] for _, dependency in lines if dependency is not None]
+    latestVersions = dict(
+        zip(paths, fetchAll(lambda path: latestGoModule(path, session), paths))
+    )
 
-                if currentVersion != latestVersion:
-                    updatedLines.append(f'\t{path} {latestVersion}{indirect}\n')
-                    printUpdate(path, currentVersion, latestVersion, 'cyan')
-                    continue
+    updatedLines = []
+    for line, dependency in lines:
+        if dependency is not None:
+            path, currentVersion, indirect = dependency
+            latestVersion = latestVersions[path]
+
+            if currentVersion != latestVersion:
+                updatedLines.append(f'\t{path} {latestVersion}{indirect}\n')
+                printUpdate(path, currentVersion, latestVersion, 'cyan')
+                continue
 
-            updatedLines.append(line)
+        updatedLines.append(line)
 
-    with open('go.mod', 'w') as goModFile:
-        for line in updatedLines:
-            goModFile.write(line)
+    writeAtomically('go.mod', ''.join(updatedLines))
 
     runOrDie([GO_PATH, 'mod', 'tidy'])
 
 
+def parseGoDependency(line: str) -> Optional[tuple[str, str, str]]:
+    """
+    Parse a line from a `require ( ... )` block in `go.mod`
+    of the form `\t<path> <version>[ // indirect]\n`.
+
+    Return the path, the version, and the indirect comment (or an empty string),
+    or `None` if the line does not have that form.
+    """
+    if not (line.startswith('\t') and line.endswith('\n')):
+        return None
+    dependency = line[1:-1]
+    indirect = ''
+    if dependency.endswith(' // indirect'):
+        dependency = dependency.removesuffix(' // indirect')
+        indirect = ' // indirect'
+    parts = dependency.split()
+    if len(parts) != 2 or ' '.join(parts) != dependency:
+        return None
+    return (parts[0], parts[1], indirect)
+
+
+def latestGoModule(path: str, session: Session) -> str:
+    # Encode the module path for the Go module proxy protocol.
+    # https://go.dev/ref/mod#goproxy-protocol
+    encodedPath = path.translate(GO_PROXY_ENCODING)
+
+    # Get the latest version using the Go module proxy protocol.
+    return requestOrDie(
+        'GET',
+        f'https://proxy.golang.org/{encodedPath}/@latest',
+        session=session,
+    ).json()['Version']
+
+
+def writeAtomically(path: str, content: str):
+    """
+    Replace the content of a file in a single write.
+
+    The content is written to a temporary sibling file which is then renamed over the original,
+    so an interrupted upgrade never leaves a half-written file behind.
+    """
+    temporaryPath = f'{path}.tmp'
+    with open(temporaryPath, 'w') as file:
+        file.write(content)
+    replace(temporaryPath, path)
+
+
 def printUpdate(name: str, oldVersion: str, newVersion: str, color: str):
     """
     Print a user-facing message to stderr indicating that a package is being updated.
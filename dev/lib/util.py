@@ -3,14 +3,17 @@ A library of useful, general values and functions for Python scripts.
 """
 
 from contextlib import contextmanager
-from datetime import datetime, timedelta
+from datetime import timedelta
+from os import read
 from shlex import quote
 from subprocess import DEVNULL, PIPE, CompletedProcess, Popen, run
-from time import sleep
+from sys import stdin
+from time import monotonic, sleep
 from typing import Callable, List, Optional
 
-from requests import Response, request
+from requests import Response, Session, request
 from rich.console import Console
+from rich.prompt import Confirm
 
 console = Console(stderr=True, highlight=False, soft_wrap=True)
 
@@ -26,7 +29,12 @@ def step(status: str):
     The exception is also re-raised, but there may be cleanup actions that occur first.
     """
     try:
-        with console.status(status):
+        if console.is_terminal:
+            with console.status(status):
+                yield
+        else:
+            # Without a terminal, the spinner can't be seen.
+            # Skip it and its background refresh thread.
             yield
     except Exception as e:
         console.print(f'[red]✘[/red] {status}')
@@ -35,37 +43,52 @@ def step(status: str):
     console.print(f'[green]✔[/green] {status}')
 
 
+def confirm(question: str, yes: bool = False) -> bool:
+    """
+    Ask the user a yes-or-no question.
+
+    If `yes` is set, answer yes without asking.
+    If stdin is not a terminal, answer no rather than blocking forever on input.
+    """
+    if yes:
+        return True
+    if not stdin.isatty():
+        console.print(f'{question} [bold]no[/bold] (not a terminal; pass --yes)')
+        return False
+    return Confirm.ask(question)
+
+
 def waitFor(
     condition: Callable[[], bool],
     description: str,
     timeout: timedelta,
     interval: timedelta,
-    minimum: Optional[timedelta] = None,
 ):
     """
     Wait for some condition to become true.
 
-    After waiting for a minimum wait time,
-    test the condition predicate at regular intervals until it returns true,
-    or a timeout expires.
+    Test the condition predicate until it returns true, or a timeout expires.
+    The delay between tests starts at one second (or `interval`, if that's shorter)
+    and doubles after every failed test, up to a maximum of `interval`.
     """
     with step(
         f'Waiting up to [bold]{int(timeout.total_seconds())}[/bold] seconds for {description}'
     ):
-        if minimum is not None:
-            sleep(min(minimum, timeout).total_seconds())
-        start = datetime.now()
-        end = start + timeout
+        # Use the monotonic clock so wall-clock adjustments can't skew the deadline.
+        start = monotonic()
+        end = start + timeout.total_seconds()
         interval = interval.total_seconds()
-        while (now := datetime.now()) < end:
+        delay = min(1, interval)
+        while (now := monotonic()) < end:
             if condition():
                 break
             else:
-                sleep(interval)
+                sleep(delay)
+                delay = min(delay * 2, interval)
         else:
             raise RuntimeError(f'Timed out waiting for {description}')
 
-    console.print(f'Ready after {int((now - start).total_seconds())} seconds')
+    console.print(f'Ready after {int(now - start)} seconds')
 
 
 def runWithStderr(*command) -> int:
@@ -76,10 +99,22 @@ def runWithStderr(*command) -> int:
     Any output written to stderr is displayed in yellow.
     If the command exits with a non-zero status, an exception is raised.
     """
-    process = Popen(command, stderr=PIPE, stdout=DEVNULL, text=True)
-
-    for line in process.stderr:
-        console.print(line.rstrip(), style='yellow')
+    process = Popen(command, stderr=PIPE, stdout=DEVNULL)
+
+    # Read stderr in large chunks straight from the file descriptor
+    # and print all complete lines from each chunk at once,
+    # rather than rendering every line individually.
+    pending = b''
+    while chunk := read(process.stderr.fileno(), 65536):
+        *lines, pending = (pending + chunk).split(b'\n')
+        if lines:
+            console.print(
+                '\n'.join(line.decode(errors='replace').rstrip() for line in lines),
+                style='yellow',
+            )
+    if pending:
+        console.print(pending.decode(errors='replace').rstrip(), style='yellow')
+    process.stderr.close()
 
     status = process.wait()
     if status != 0:
@@ -105,12 +140,17 @@ def runOrDie(
     return result
 
 
-def requestOrDie(method: str, url: str, *args, **kwargs) -> Response:
+def requestOrDie(
+    method: str, url: str, *args, session: Optional[Session] = None, **kwargs
+) -> Response:
     """
     Drop-in replacement for `requests.request`
     that raises with a helpful message if the response status is non-successful.
+
+    If a session is provided, send the request through it
+    to reuse pooled keep-alive connections.
     """
-    response = request(method, url, *args, **kwargs)
+    response = (session.request if session else request)(method, url, *args, **kwargs)
     if not response.ok:
         raise RuntimeError(
             f"Error requesting '{url}' with {method}:\n"
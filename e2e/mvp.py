@@ -12,12 +12,21 @@ environ['GRPC_DEFAULT_SSL_ROOTS_FILE_PATH'] = 'e2e/mvp-certificates.root.cert'
 
 
 class Walkthough(TestCase):
-    def test_WIP(self):
-        adderClient = AdderServiceStub(
-            grpc.secure_channel('api.vimana.host', grpc.ssl_channel_credentials()),
+    @classmethod
+    def setUpClass(cls):
+        # Open one channel for the whole test case,
+        # so the TLS handshake is paid once rather than per test.
+        cls.channel = grpc.secure_channel(
+            'api.vimana.host', grpc.ssl_channel_credentials()
         )
+        cls.adderClient = AdderServiceStub(cls.channel)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.channel.close()
 
-        response = adderClient.AddFloats(AddFloatsRequest(x=3.5, y=-1.2))
+    def test_WIP(self):
+        response = self.adderClient.AddFloats(AddFloatsRequest(x=3.5, y=-1.2))
 
         self.assertEqual(response, AddFloatsResponse(result=2.3))
 
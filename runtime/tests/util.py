@@ -1,6 +1,6 @@
 """Test harness and helper functions for the work runtime."""
 
-from collections import defaultdict
+from collections import defaultdict, deque
 from collections.abc import Callable
 from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
@@ -8,25 +8,25 @@ from datetime import datetime, timedelta
 from functools import partial, wraps
 from hashlib import sha256
 from http import HTTPStatus
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
 from ipaddress import IPv4Address, IPv6Address
 from itertools import chain, repeat
+from json import dumps as serializeJson
 from json import loads as parseJson
-from os import chmod, getpid, stat, walk
-from os.path import exists, join
-from queue import Empty, Queue, ShutDown
-from random import randrange
+from os import fchmod, getpid, read, scandir
+from os.path import join
 from re import Match
 from re import compile as compileRegex
+from select import select
 from shlex import quote
-from socket import AF_INET, SOCK_STREAM, socket
+from socket import AF_INET, AF_UNIX, SOCK_STREAM, socket
 from stat import S_IEXEC, S_IREAD
-from subprocess import PIPE, Popen
+from subprocess import PIPE, Popen, TimeoutExpired
 from sys import stderr
-from tempfile import NamedTemporaryFile, TemporaryDirectory
-from threading import Thread
+from tempfile import NamedTemporaryFile, TemporaryDirectory, gettempdir
+from threading import Event, Lock, Thread
 from time import sleep
-from typing import Any, Optional, TextIO
+from typing import Any, BinaryIO, Optional
 from unittest import TestCase
 from uuid import uuid4
 
@@ -68,12 +68,14 @@ TIMEOUT = timedelta(seconds=5)
 # because the network namespace is partitioned by Bazel,
 # hence using global variables to manage the temporary file lifecycle.
 IPAM_DATABASE = NamedTemporaryFile()
-IPAM_WRAPPER = NamedTemporaryFile(mode='w', delete_on_close=False)
-IPAM_WRAPPER.write(f"""#!/usr/bin/env bash
+IPAM_WRAPPER = NamedTemporaryFile(delete_on_close=False)
+ipamScript = f"""#!/usr/bin/env bash
 exec {quote(IPAM_PATH)} {quote(IPAM_DATABASE.name)}
-""")
+"""
+IPAM_WRAPPER.write(ipamScript.encode())
+# Make the script executable through the open descriptor before closing it.
+fchmod(IPAM_WRAPPER.fileno(), S_IEXEC | S_IREAD)
 IPAM_WRAPPER.close()
-chmod(IPAM_WRAPPER.name, S_IEXEC | S_IREAD)
 
 # The name of the Vimana runtime.
 RUNTIME_NAME = 'vimana'
@@ -144,7 +146,7 @@ class VimanadTester:
                 # Wait for both the image registry and downstream runtime to become connectable
                 # before starting `vimanad`.
                 _waitFor(
-                    lambda: exists(downstreamSocket)
+                    lambda: _isUdsReady(downstreamSocket)
                     and not _isPortAvailable(self._imageRegistryPort),
                 )
                 self._imageStore = TemporaryDirectory()
@@ -157,21 +159,29 @@ class VimanadTester:
                 try:
                     # We need a separate thread just to collect the logs:
                     # https://stackoverflow.com/a/4896288/5712883.
-                    self._vimanadLogQueue = Queue()
+                    self._vimanadLogLines = deque()
+                    self._vimanadLogsClosed = Event()
                     Thread(
                         target=_collectLogs,
-                        args=(self._vimanad.stdout, self._vimanadLogQueue),
+                        args=(
+                            self._vimanad.stdout,
+                            self._vimanadLogLines,
+                            self._vimanadLogsClosed,
+                        ),
                         daemon=True,  # Shut down the thread if the parent process exits.
                     ).start()
                     try:
-                        # Wait for `vimanad` to become connectable before opening client channels.
-                        _waitFor(lambda: exists(self._vimanadSocket))
-                        self._runtimeChannel = self._channel()
-                        self._imageChannel = self._channel()
-                        self.runtimeService = RuntimeServiceStub(self._runtimeChannel)
-                        self.imageService = ImageServiceStub(self._imageChannel)
+                        # Wait for `vimanad` to become connectable before opening a client channel.
+                        _waitFor(lambda: _isUdsReady(self._vimanadSocket))
+                        # Both services are served from the same socket,
+                        # so the stubs can share a single channel (and connection).
+                        self._channel = self._openChannel()
+                        self.runtimeService = RuntimeServiceStub(self._channel)
+                        self.imageService = ImageServiceStub(self._channel)
+                        # Started lazily by the first `pushImage`.
+                        self._pushWorker: Optional[Popen] = None
                     except:
-                        self._vimanadLogQueue.shutdown()
+                        self._vimanadLogsClosed.set()
                         raise
                 except:
                     self._vimanad.terminate()
@@ -184,7 +194,7 @@ class VimanadTester:
             self._imageRegistry.server_close()
             raise
 
-    def _channel(self):
+    def _openChannel(self):
         # Set authority: https://github.com/grpc/grpc/issues/34305.
         return grpc.insecure_channel(
             f'unix://{self._vimanadSocket}',
@@ -196,8 +206,8 @@ class VimanadTester:
 
     def __exit__(self, exc_type, exc_value, traceback):
         try:
-            self._runtimeChannel.close()
-            self._imageChannel.close()
+            self._channel.close()
+            self._stopPushWorker()
         finally:
             try:
                 self._vimanad.terminate()
@@ -209,7 +219,7 @@ class VimanadTester:
                     try:
                         self._downstreamRuntime.stop(TIMEOUT.total_seconds())
                     finally:
-                        self._vimanadLogQueue.shutdown()
+                        self._vimanadLogsClosed.set()
 
     def pushImage(
         self, domain: str, server: str, version: str, module: str, metadata: str
@@ -223,18 +233,67 @@ class VimanadTester:
             module:    Path to compiled Wasm component byte code file.
             metadata:  Path to serialized gRPC service metadata file.
         """
-        command = [
-            PUSH_IMAGE_PATH,
-            f'--registry=http://localhost:{self._imageRegistryPort}',
-            f'--domain={domain}',
-            f'--server={server}',
-            f'--version={version}',
-            f'--component={module}',
-            f'--metadata={metadata}',
-        ]
-        status = Popen(command).wait(TIMEOUT.total_seconds())
-        if status != 0:
-            raise RuntimeError(f'Failed to push image (status={status}).')
+        if self._pushWorker is None:
+            # Keep a single push process running for the lifetime of the tester,
+            # sending it one image per line, rather than starting one per image.
+            self._pushWorker = Popen(
+                [
+                    PUSH_IMAGE_PATH,
+                    f'--registry=http://localhost:{self._imageRegistryPort}',
+                    '--stdin',
+                ],
+                stdin=PIPE,
+                stdout=PIPE,
+                text=True,
+            )
+        request = {
+            'domain': domain,
+            'server': server,
+            'version': version,
+            'component': module,
+            'metadata': metadata,
+        }
+        worker = self._pushWorker
+        try:
+            worker.stdin.write(serializeJson(request) + '\n')
+            worker.stdin.flush()
+            # The worker writes exactly one line per request,
+            # so nothing is left buffered between requests.
+            if not select([worker.stdout], [], [], TIMEOUT.total_seconds())[0]:
+                raise RuntimeError('Timed out pushing image.')
+            response = worker.stdout.readline()
+            if not response:
+                status = worker.wait(TIMEOUT.total_seconds())
+                raise RuntimeError(f'Image push worker exited (status={status}).')
+            error = parseJson(response)
+        except:
+            # A reply may still be pending, which the next push would mistake for its own,
+            # so replace the worker rather than reuse it.
+            self._stopPushWorker(kill=True)
+            raise
+        if error is not None:
+            raise RuntimeError(f'Failed to push image: {error}')
+
+    def _stopPushWorker(self, kill: bool = False):
+        """Shut down the push worker, if any, so the next push starts a fresh one."""
+        worker, self._pushWorker = self._pushWorker, None
+        if worker is None:
+            return
+        try:
+            if kill:
+                worker.kill()
+            try:
+                # Closing standard input tells the push worker to exit.
+                worker.stdin.close()
+            except BrokenPipeError:
+                pass  # The worker is already gone.
+            try:
+                worker.wait(TIMEOUT.total_seconds())
+            except TimeoutExpired:
+                worker.kill()
+                worker.wait()
+        finally:
+            worker.stdout.close()
 
     def setupImage(
         self,
@@ -288,13 +347,17 @@ class VimanadTester:
 
         usedBytes = 0
         inodesUsed = 0
-        for directory, _, filenames in walk(self._imageStore.name):
-            # The runtime does not count the root directory when counting inodes.
-            if directory != self._imageStore.name:
-                inodesUsed += 1
-            for filename in filenames:
-                inodesUsed += 1
-                usedBytes += stat(join(directory, filename)).st_size
+        # The runtime does not count the root directory when counting inodes,
+        # so only count the entries found within each directory.
+        directories = [self._imageStore.name]
+        while directories:
+            with scandir(directories.pop()) as entries:
+                for entry in entries:
+                    inodesUsed += 1
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    else:
+                        usedBytes += entry.stat().st_size
 
         testCase.assertEqual(reportedUsage.used_bytes.value, usedBytes)
         testCase.assertEqual(reportedUsage.inodes_used.value, inodesUsed)
@@ -306,15 +369,10 @@ class VimanadTester:
         Return the list of available log lines that have been written by `vimanad`
         since last invocation.
         """
-        # `sleep(0)` yields the GIL
-        # so the background log collector thread can run if it needs to.
-        sleep(0)
-        logs = []
-        while True:
-            try:
-                logs.append(self._vimanadLogQueue.get(block=False))
-            except (Empty, ShutDown):
-                return logs
+        # Appending and popping from opposite ends of a deque is thread-safe,
+        # so only take as many lines as are available right now.
+        lines = self._vimanadLogLines
+        return [lines.popleft() for _ in range(len(lines))]
 
     def printVimanadLogs(self, testCase: TestCase):
         """Print collected `vimanad` logs to standard error, if there are any."""
@@ -350,9 +408,9 @@ def startVimanad(
         f'--network-interface={networkInterface}',
         f'--pod-ips={podIps}',
     ]
-    # Open a line-buffered text-mode pipe for stdout
-    # and convert all CR/LF sequences to plain LF.
-    process = Popen(command, stdout=PIPE, text=True, bufsize=1)
+    # Open a binary pipe for stdout.
+    # The log collector reads it in chunks and splits lines itself.
+    process = Popen(command, stdout=PIPE)
     return (process, socket)
 
 
@@ -379,8 +437,9 @@ def startImageRegistry() -> tuple[HTTPServer, int]:
 
     Return the running server and the port number where it's listening.
     """
-    port = _findAvailablePort()
-    server = FakeImageRegistryServer(port)
+    # Bind to port 0 to let the kernel pick an available port atomically.
+    server = FakeImageRegistryServer(0)
+    port = server.server_address[1]
     Thread(
         target=server.serve_forever,
         daemon=True,  # Shut down the thread if the parent process exits.
@@ -400,16 +459,6 @@ def ipHostName(address: IPv4Address | IPv6Address) -> str:
     return f'[{address}]' if isinstance(address, IPv6Address) else str(address)
 
 
-def _findAvailablePort(attempts: int = 5) -> int:
-    """Find an available TCP port by random probing."""
-    for i in range(attempts):
-        # Pick a random port in the ephemeral range: [49152–65536).
-        port = randrange(49152, 65536)
-        if _isPortAvailable(port):
-            return port
-    raise RuntimeError(f'Could not find an open port after {attempts} attempts.')
-
-
 def _isPortAvailable(port: int) -> bool:
     with closing(socket(AF_INET, SOCK_STREAM)) as sock:
         errno = sock.connect_ex(('localhost', port))
@@ -420,24 +469,46 @@ def _isPortAvailable(port: int) -> bool:
     return False
 
 
-def _collectLogs(stdout: TextIO, queue: Queue):
-    """Read all lines from the `stdout` pipe, adding each line to the queue."""
-    # Invoke `readline` iteratively until EOF is indicated by the sentinel value `b''`.
-    for line in iter(stdout.readline, b''):
+def _isUdsReady(path: str) -> bool:
+    """Return true iff a server is accepting connections on the UNIX socket at `path`."""
+    with closing(socket(AF_UNIX, SOCK_STREAM)) as sock:
         try:
-            queue.put(line)
-        except ShutDown:
+            sock.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return False
+    return True
+
+
+def _collectLogs(stdout: BinaryIO, lines: deque, closed: Event):
+    """Read all lines from the `stdout` pipe, appending each line to the deque."""
+    # Read whatever is available in large chunks, until EOF is indicated by `b''`,
+    # and append all the complete lines from each chunk at once.
+    # Any partial line is carried over to the next chunk.
+    pending = b''
+    while chunk := read(stdout.fileno(), 65536):
+        if closed.is_set():
             # If the test is shutting down, nobody wants the remaining logs.
             break
+        *complete, pending = (pending + chunk).split(b'\n')
+        # Convert all CR/LF sequences to plain LF.
+        lines.extend(
+            line.decode(errors='replace').removesuffix('\r') + '\n' for line in complete
+        )
+    else:
+        if pending:
+            lines.append(pending.decode(errors='replace'))
     stdout.close()
 
 
 def _waitFor(predicate: Callable[[], bool]):
     start = datetime.now()
+    interval = 1 / 256
     while not predicate():
         if datetime.now() - start > TIMEOUT:
             raise RuntimeError('Timed out polling for condition')
-        sleep(1 / 32)  # ~30ms
+        sleep(interval)
+        # Start polling fast (~4ms), then back off exponentially up to ~30ms.
+        interval = min(interval * 2, 1 / 32)
 
 
 def _readFile(path: str) -> bytes:
@@ -447,10 +518,11 @@ def _readFile(path: str) -> bytes:
 
 def _tmpName() -> str:
     """Return a unique name for a hypothetical temporary file that does not exist."""
-    f = NamedTemporaryFile()
-    name = f.name
-    f.close()  # Delete the file.
-    return name
+    # 64 random bits make a collision (e.g. with a socket left behind by a crashed run)
+    # vanishingly unlikely, without touching the disk.
+    # Keep it short: these names are used for UNIX sockets,
+    # whose paths are limited to ~100 bytes.
+    return join(gettempdir(), f'vimana-{uuid4().hex[:16]}')
 
 
 # Regular expressions used by the fake image registry.
@@ -464,6 +536,17 @@ _putBlobPath = compileRegex(
 _getBlobPath = compileRegex(r'^/v2/(.+)/blobs/sha256:([0-9a-f]{64})$')
 _manifestPath = compileRegex(r'^/v2/(.+)/manifests/([^/]+)$')
 
+
+def _parentSegment(path: str) -> str:
+    """Return the second-to-last segment of a URL path.
+
+    None of the patterns above allow a slash in their final segment,
+    so this cheaply determines which (if any) of them could match a given path.
+    """
+    segments = path.rsplit('/', 2)
+    return segments[-2] if len(segments) > 1 else ''
+
+
 # MIME types:
 OCTET_STREAM_MIME_TYPE = 'application/octet-stream'
 IMAGE_MANIFEST_MIME_TYPE = 'application/vnd.oci.image.manifest.v1+json'
@@ -472,11 +555,16 @@ WASM_MIME_TYPE = 'application/wasm'
 PROTOBUF_MIME_TYPE = 'application/protobuf'
 
 
-class FakeImageRegistryServer(HTTPServer):
+class FakeImageRegistryServer(ThreadingHTTPServer):
+    """Handles each request in its own thread so that transfers can overlap."""
+
     def __init__(self, port):
-        self.nameToUploadIds = defaultdict(set)
-        self.nameToHashToBlob = defaultdict(dict)
-        self.nameToReferenceToManifest = defaultdict(dict)
+        # Guards the upload IDs and blobs, which are checked and updated together.
+        self.lock = Lock()
+        # Flat tables keyed by `(name, id)` pairs.
+        self.uploadIds: set[tuple[str, str]] = set()
+        self.blobs: dict[tuple[str, str], bytes] = {}
+        self.manifests: dict[tuple[str, str], bytes] = {}
         super().__init__(('localhost', port), FakeImageRegistryHandler)
 
 
@@ -487,7 +575,8 @@ class FakeImageRegistryHandler(BaseHTTPRequestHandler):
             name = path.group(1)
             uploadId = str(uuid4())
 
-            self.server.nameToUploadIds[name].add(uploadId)
+            with self.server.lock:
+                self.server.uploadIds.add((name, uploadId))
 
             self.send_response(HTTPStatus.ACCEPTED.value)
             self.send_header('Location', f'/v2/{name}/blobs/uploads/{uploadId}')
@@ -498,10 +587,9 @@ class FakeImageRegistryHandler(BaseHTTPRequestHandler):
 
     def do_PUT(self):
         # Uploads actual data (either a blob or a manifest).
-        if path := _putBlobPath.match(self.path):
-            name = path.group(1)
-            uploadId = path.group(2)
-            blobSha256 = path.group(3)
+        parent = _parentSegment(self.path)
+        if parent == 'uploads' and (path := _putBlobPath.match(self.path)):
+            name, uploadId, blobSha256 = path.groups()
             contentLength = int(self.headers['Content-Length'])
             blob = self.rfile.read(contentLength)
 
@@ -513,20 +601,21 @@ class FakeImageRegistryHandler(BaseHTTPRequestHandler):
             if _sha256(blob) != blobSha256:
                 self.send_error(HTTPStatus.BAD_REQUEST.value, message='bad digest')
                 return
-            if uploadId not in self.server.nameToUploadIds[name]:
+            with self.server.lock:
+                uploadFound = (name, uploadId) in self.server.uploadIds
+                if uploadFound:
+                    self.server.uploadIds.remove((name, uploadId))
+                    self.server.blobs[(name, blobSha256)] = blob
+            if not uploadFound:
                 self.send_error(HTTPStatus.NOT_FOUND.value)
                 return
 
-            self.server.nameToUploadIds[name].remove(uploadId)
-            self.server.nameToHashToBlob[name][blobSha256] = blob
-
             self.send_response(HTTPStatus.CREATED.value)
             self.send_header('Location', f'/v2/{name}/blobs/sha256:{blobSha256}')
             self.end_headers()
 
-        elif path := _manifestPath.match(self.path):
-            name = path.group(1)
-            reference = path.group(2)
+        elif parent == 'manifests' and (path := _manifestPath.match(self.path)):
+            name, reference = path.groups()
             contentLength = int(self.headers['Content-Length'])
             manifestBytes = self.rfile.read(contentLength)
 
@@ -552,7 +641,7 @@ class FakeImageRegistryHandler(BaseHTTPRequestHandler):
                 self.send_error(HTTPStatus.BAD_REQUEST.value, message='bad manifest')
                 return
 
-            self.server.nameToReferenceToManifest[name][reference] = manifestBytes
+            self.server.manifests[(name, reference)] = manifestBytes
 
             self.send_response(HTTPStatus.CREATED.value)
             self.send_header(
@@ -574,7 +663,7 @@ class FakeImageRegistryHandler(BaseHTTPRequestHandler):
         """
         # Remove the digest prefix to look it up in the map.
         blobSha256 = descriptor['digest'][len('sha256:') :]
-        blob = self.server.nameToHashToBlob[name][blobSha256]
+        blob = self.server.blobs.get((name, blobSha256))
         return (
             isinstance(blob, bytes)
             and descriptor['mediaType'] == mediaType
@@ -583,22 +672,22 @@ class FakeImageRegistryHandler(BaseHTTPRequestHandler):
 
     def do_GET(self):
         # Retrieve either a blob or a manifest.
-        if path := _getBlobPath.match(self.path):
-            self._getBoilerplate(path, self.server.nameToHashToBlob)
-        elif path := _manifestPath.match(self.path):
-            self._getBoilerplate(path, self.server.nameToReferenceToManifest)
+        parent = _parentSegment(self.path)
+        if parent == 'blobs' and (path := _getBlobPath.match(self.path)):
+            self._getBoilerplate(path, self.server.blobs)
+        elif parent == 'manifests' and (path := _manifestPath.match(self.path)):
+            self._getBoilerplate(path, self.server.manifests)
         else:
             self.send_error(HTTPStatus.BAD_REQUEST.value, message='invalid URL')
 
-    def _getBoilerplate(self, path: Match, table: dict[str, dict[str, bytes]]):
+    def _getBoilerplate(self, path: Match, table: dict[tuple[str, str], bytes]):
         """Common logic shared between blob-fetching and manifest-fetching."""
-        name = path.group(1)
-        digestOrReference = path.group(2)
+        name, digestOrReference = path.groups()
 
-        if digestOrReference not in table[name]:
+        blobOrManifest = table.get((name, digestOrReference))
+        if blobOrManifest is None:
             self.send_error(HTTPStatus.NOT_FOUND.value)
             return
-        blobOrManifest = table[name][digestOrReference]
 
         self.send_response(HTTPStatus.OK.value)
         self.end_headers()
@@ -616,9 +705,7 @@ class FakeImageRegistryHandler(BaseHTTPRequestHandler):
 
 
 def _sha256(data: bytes) -> str:
-    hasher = sha256()
-    hasher.update(data)
-    return hasher.hexdigest()
+    return sha256(data).hexdigest()
 
 
 class Mockable:
@@ -632,9 +719,7 @@ class Mockable:
         Mock the next `count` invocations of a named function,
         reverting back to the prior behavior thereafter.
         """
-        self._mocks[methodName] = chain(
-            repeat(function, count), self._mocks[methodName]
-        )
+        self._mocks[methodName].extendleft(repeat(function, count))
 
     def returnNext(self, methodName: str, value: object, count: int = 1):
         """
@@ -645,13 +730,12 @@ class Mockable:
 
     def clear(self) -> bool:
         """Unmock every instance method."""
-        # Mapping from method names to iterators of mock implementations.
-        self._mocks = defaultdict(lambda: iter([]))
+        # Mapping from method names to queues of mock implementations.
+        self._mocks = defaultdict(deque)
 
     def isClear(self) -> bool:
         """Return true iff every instance method is unmocked."""
-        sentinel = object()
-        return all(next(mocks, sentinel) is sentinel for mocks in self._mocks.values())
+        return not any(self._mocks.values())
 
 
 def mockable(method: Callable) -> Callable:
@@ -662,9 +746,10 @@ def mockable(method: Callable) -> Callable:
 
     @wraps(method)
     def hook(self, *args, **kwargs):
-        # Use the next mock implementation available in this method's mock iterator.
-        # If the iterator is empty, use the original default implementation.
-        return next(self._mocks[method.__name__], method)(self, *args, **kwargs)
+        # Use the next mock implementation available in this method's mock queue.
+        # If the queue is empty, use the original default implementation.
+        mocks = self._mocks[method.__name__]
+        return (mocks.popleft() if mocks else method)(self, *args, **kwargs)
 
     return hook
 